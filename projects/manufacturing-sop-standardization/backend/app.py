@@ -1,22 +1,49 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson
 import os
+import shutil
 from werkzeug.utils import secure_filename
 import logging
 import threading
 import time
+import atexit
+import traceback
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
 from document_processor import DocumentProcessor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Serialize responses with orjson (handles numpy arrays and scalars natively)"""
+    
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    
+    def dumps(self, obj, **kwargs):
+        option = self.options
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf', 'docx'}
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024  # Stream uploads to disk in 1MB blocks
+CONVERTED_DOCUMENTS_FOLDER = os.path.abspath('converted_documents')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -28,30 +55,117 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 # Initialize services
 document_processor = DocumentProcessor()
 
-# Processing status tracking
-processing_status = {}
-processing_lock = threading.Lock()
+def warm_up_models():
+    """Load the embedding models in the background so the first upload doesn't pay for it"""
+    try:
+        document_processor.embedding_service.model
+        document_processor.vector_db_service.embedding_model
+    except Exception as e:
+        logger.error(f"Model warm-up failed: {str(e)}")
+
+threading.Thread(target=warm_up_models, name='model-warmup', daemon=True).start()
+
+# Processing status tracking. Entries are immutable snapshots that are
+# replaced wholesale, so readers never see a half-updated job. Finished jobs
+# expire an hour after their last update; TTLCache isn't thread-safe, so
+# point reads and writes take a short lock.
+processing_status = TTLCache(maxsize=10_000, ttl=3600)
+processing_status_lock = threading.Lock()
+
+# Bounded worker pool for document processing (embedding work is heavy, so
+# a burst of uploads queues here instead of spawning a thread per file)
+executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('SOP_WORKERS', 4)),
+    thread_name_prefix='sop-proc'
+)
+atexit.register(executor.shutdown, wait=False)
+
+# Cache for document-pair comparisons, keyed on the exact-match index revision
+# so results are dropped as soon as a document is added or removed
+compare_cache = TTLCache(maxsize=512, ttl=900)
+compare_cache_lock = threading.Lock()
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def set_processing_status(job_id, snapshot):
+    """Publish a new status snapshot for a job, keeping its submission time"""
+    with processing_status_lock:
+        previous = processing_status.get(job_id, {})
+        processing_status[job_id] = {'submitted_at': previous.get('submitted_at', time.time()), **snapshot}
+
+def update_processing_status(job_id, **changes):
+    """Publish a snapshot that changes some fields of a job's current status"""
+    with processing_status_lock:
+        previous = processing_status.get(job_id, {})
+        processing_status[job_id] = {**previous, **changes}
+
+# Shared page comparison service, created on first use (the module is optional)
+page_comparison_service = None
+page_comparison_lock = threading.Lock()
+
+# Short-lived directory listings so repeat lookups don't stat() the disk
+directory_listing_cache = TTLCache(maxsize=8, ttl=5)
+directory_listing_lock = threading.Lock()
+
+def file_in_directory(directory, filename):
+    """Check whether a file exists in a directory using a cached listing"""
+    if os.sep in filename or (os.altsep and os.altsep in filename):
+        return os.path.isfile(os.path.join(directory, filename))
+    
+    with directory_listing_lock:
+        listing = directory_listing_cache.get(directory)
+    if listing is not None and filename in listing:
+        return True
+    
+    # Not in the cached listing: refresh it, since the file may be new
+    try:
+        listing = frozenset(os.listdir(directory))
+    except FileNotFoundError:
+        listing = frozenset()
+    with directory_listing_lock:
+        directory_listing_cache[directory] = listing
+    return filename in listing
+
+def get_page_comparison_service():
+    """Return the shared PageComparisonService, importing it on first use"""
+    global page_comparison_service
+    if page_comparison_service is None:
+        with page_comparison_lock:
+            if page_comparison_service is None:
+                from page_comparison_service import PageComparisonService
+                page_comparison_service = PageComparisonService()
+    return page_comparison_service
+
+def cached_comparison(endpoint, doc1_name, doc2_name, compare):
+    """Run a document-pair comparison through the cache; returns (results, cache_hit)"""
+    # Results are directional (doc1 vs doc2), so the pair is not sorted
+    key = (endpoint, doc1_name, doc2_name, document_processor.exact_match_service.revision)
+    with compare_cache_lock:
+        results = compare_cache.get(key)
+    if results is not None:
+        return results, True
+    
+    results = compare()
+    if 'error' not in results:
+        with compare_cache_lock:
+            compare_cache[key] = results
+    return results, False
+
 def process_document_async(filepath, filename, job_id):
     """Process document asynchronously"""
     try:
-        with processing_lock:
-            processing_status[job_id] = {
-                'status': 'processing',
-                'filename': filename,
-                'progress': 0,
-                'message': 'Starting document processing...'
-            }
+        set_processing_status(job_id, {
+            'status': 'processing',
+            'filename': filename,
+            'progress': 0,
+            'message': 'Starting document processing...'
+        })
         
         # Update progress
-        with processing_lock:
-            processing_status[job_id]['progress'] = 20
-            processing_status[job_id]['message'] = 'Extracting text and detecting sections...'
+        update_processing_status(job_id, progress=20, message='Extracting text and detecting sections...')
         
         # Process document
         try:
@@ -76,41 +190,38 @@ def process_document_async(filepath, filename, job_id):
             raise Exception(error_msg)
         
         # Update progress
-        with processing_lock:
-            processing_status[job_id]['progress'] = 80
-            processing_status[job_id]['message'] = 'Generating embeddings and hashes...'
+        update_processing_status(job_id, progress=80, message='Generating embeddings and hashes...')
         
         # Get statistics
         vector_stats = document_processor.get_vector_db_stats()
         exact_match_stats = document_processor.get_exact_match_stats()
         
         # Complete processing
-        with processing_lock:
-            processing_status[job_id] = {
-                'status': 'completed',
-                'filename': filename,
-                'progress': 100,
-                'message': 'Processing completed successfully',
-                'result': {
-                    'vector_chunk_count': doc_data.get('vector_chunk_count', 0),
-                    'vector_db_stored': doc_data.get('vector_db_stored', False),
-                    'exact_match_enabled': doc_data.get('exact_match_enabled', False),
-                    'vector_db_stats': vector_stats,
-                    'exact_match_stats': exact_match_stats
-                }
+        set_processing_status(job_id, {
+            'status': 'completed',
+            'filename': filename,
+            'progress': 100,
+            'message': 'Processing completed successfully',
+            'result': {
+                'vector_chunk_count': doc_data.get('vector_chunk_count', 0),
+                'vector_db_stored': doc_data.get('vector_db_stored', False),
+                'file_sha256': doc_data.get('file_sha256'),
+                'exact_match_enabled': doc_data.get('exact_match_enabled', False),
+                'vector_db_stats': vector_stats,
+                'exact_match_stats': exact_match_stats
             }
+        })
         
         logger.info(f"Async processing completed for {filename}")
         
     except Exception as e:
-        with processing_lock:
-            processing_status[job_id] = {
-                'status': 'error',
-                'filename': filename,
-                'progress': 0,
-                'message': f'Processing failed: {str(e)}',
-                'error': str(e)
-            }
+        set_processing_status(job_id, {
+            'status': 'error',
+            'filename': filename,
+            'progress': 0,
+            'message': f'Processing failed: {str(e)}',
+            'error': str(e)
+        })
         logger.error(f"Async processing failed for {filename}: {str(e)}")
 
 @app.route('/health', methods=['GET'])
@@ -136,17 +247,22 @@ def upload_files_vector():
                 # Save uploaded file
                 filename = secure_filename(file.filename)
                 filepath = os.path.join(UPLOAD_FOLDER, filename)
-                file.save(filepath)
+                with open(filepath, 'wb') as fh:
+                    shutil.copyfileobj(file.stream, fh, length=UPLOAD_COPY_BUFFER_SIZE)
                 
                 # Generate unique job ID
                 job_id = f"{filename}_{int(time.time())}"
                 
+                # Mark as queued so the job is visible before a worker picks it up
+                set_processing_status(job_id, {
+                    'status': 'queued',
+                    'filename': filename,
+                    'progress': 0,
+                    'message': 'Waiting for a free worker...'
+                })
+                
                 # Start async processing
-                thread = threading.Thread(
-                    target=process_document_async,
-                    args=(filepath, filename, job_id)
-                )
-                thread.start()
+                executor.submit(process_document_async, filepath, filename, job_id)
                 
                 processing_jobs.append({
                     "job_id": job_id,
@@ -269,11 +385,16 @@ def compare_documents_exact():
         doc1_name = data['doc1']
         doc2_name = data['doc2']
         
-        comparison = document_processor.compare_documents_exact(doc1_name, doc2_name)
-        return jsonify({
+        comparison, cache_hit = cached_comparison(
+            'compare_exact', doc1_name, doc2_name,
+            lambda: document_processor.compare_documents_exact(doc1_name, doc2_name)
+        )
+        response = jsonify({
             "message": "Exact comparison completed",
             "results": comparison
-        }), 200
+        })
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response, 200
         
     except Exception as e:
         logger.error(f"Exact comparison error: {str(e)}")
@@ -293,11 +414,33 @@ def get_exact_match_stats():
         logger.error(f"Exact match stats error: {str(e)}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/processing_status', methods=['GET'])
+def get_processing_summary():
+    """Get a summary of tracked processing jobs"""
+    try:
+        with processing_status_lock:
+            jobs = list(processing_status.values())
+        
+        now = time.time()
+        active_jobs = [job for job in jobs if job.get('status') in ('queued', 'processing')]
+        oldest_submission = min((job['submitted_at'] for job in jobs), default=None)
+        
+        return jsonify({
+            "tracked_jobs": len(jobs),
+            "active_jobs": len(active_jobs),
+            "max_tracked_jobs": processing_status.maxsize,
+            "oldest_job_age_seconds": round(now - oldest_submission, 1) if oldest_submission else None
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Processing summary error: {str(e)}")
+        return jsonify({"error": "Internal server error"}), 500
+
 @app.route('/processing_status/<job_id>', methods=['GET'])
 def get_processing_status(job_id):
     """Get processing status for a specific job"""
     try:
-        with processing_lock:
+        with processing_status_lock:
             status = processing_status.get(job_id, {"error": "Job not found"})
         
         return jsonify({
@@ -320,11 +463,16 @@ def compare_documents_sentence_level():
         doc1_name = data['doc1']
         doc2_name = data['doc2']
         
-        comparison = document_processor.exact_match_service.compare_documents_sentence_level(doc1_name, doc2_name)
-        return jsonify({
+        comparison, cache_hit = cached_comparison(
+            'compare_sentence_level', doc1_name, doc2_name,
+            lambda: document_processor.exact_match_service.compare_documents_sentence_level(doc1_name, doc2_name)
+        )
+        response = jsonify({
             "message": "Sentence-level comparison completed",
             "results": comparison
-        }), 200
+        })
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response, 200
         
     except Exception as e:
         logger.error(f"Sentence-level comparison error: {str(e)}")
@@ -341,11 +489,16 @@ def get_document_differences():
         doc1_name = data['doc1']
         doc2_name = data['doc2']
         
-        differences = document_processor.exact_match_service.get_document_differences(doc1_name, doc2_name)
-        return jsonify({
+        differences, cache_hit = cached_comparison(
+            'get_differences', doc1_name, doc2_name,
+            lambda: document_processor.exact_match_service.get_document_differences(doc1_name, doc2_name)
+        )
+        response = jsonify({
             "message": "Document differences retrieved",
             "results": differences
-        }), 200
+        })
+        response.headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        return response, 200
         
     except Exception as e:
         logger.error(f"Get differences error: {str(e)}")
@@ -362,17 +515,15 @@ def get_page_comparison():
         doc1_name = data['doc1']
         doc2_name = data['doc2']
         
-        # Get file paths
-        doc1_path = os.path.join('uploads', doc1_name)
-        doc2_path = os.path.join('uploads', doc2_name)
-        
-        if not os.path.exists(doc1_path) or not os.path.exists(doc2_path):
+        if not file_in_directory(UPLOAD_FOLDER, doc1_name) or not file_in_directory(UPLOAD_FOLDER, doc2_name):
             return jsonify({"error": "One or both documents not found"}), 404
         
+        # Get file paths
+        doc1_path = os.path.join(UPLOAD_FOLDER, doc1_name)
+        doc2_path = os.path.join(UPLOAD_FOLDER, doc2_name)
+        
         # Perform page-by-page comparison
-        from page_comparison_service import PageComparisonService
-        comparison_service = PageComparisonService()
-        results = comparison_service.compare_documents_page_by_page(doc1_path, doc2_path)
+        results = get_page_comparison_service().compare_documents_page_by_page(doc1_path, doc2_path)
         
         return jsonify({
             "message": "Page comparison completed",
@@ -380,7 +531,6 @@ def get_page_comparison():
         }), 200
         
     except Exception as e:
-        import traceback
         logger.error(f"Page comparison error: {str(e)}")
         logger.error(f"Traceback: {traceback.format_exc()}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
@@ -390,20 +540,21 @@ def serve_converted_document(filename):
     """Serve converted HTML documents"""
     try:
         # URL decode the filename
-        from urllib.parse import unquote
         decoded_filename = unquote(filename)
         
-        file_path = os.path.join('converted_documents', decoded_filename)
-        logger.info(f"Serving HTML file: {file_path}")
+        logger.info(f"Serving HTML file: {decoded_filename}")
         
-        if os.path.exists(file_path):
-            return send_file(file_path, mimetype='text/html')
+        if file_in_directory(CONVERTED_DOCUMENTS_FOLDER, decoded_filename):
+            # Conditional responses let the browser revalidate with ETag / If-None-Match
+            return send_from_directory(
+                CONVERTED_DOCUMENTS_FOLDER, decoded_filename,
+                mimetype='text/html', conditional=True, etag=True, max_age=300
+            )
         else:
-            logger.error(f"File not found: {file_path}")
+            logger.error(f"File not found: {decoded_filename}")
             return jsonify({"error": f"File not found: {decoded_filename}"}), 404
     except Exception as e:
         logger.error(f"Error serving converted document: {str(e)}")
-        import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
         return jsonify({"error": f"Internal server error: {str(e)}"}), 500
 
@@ -1,10 +1,12 @@
 import os
 import logging
+import hashlib
 from typing import Dict, List, Optional
 from docx import Document
 import PyPDF2
 import pdfplumber
 import json
+from concurrent.futures import ThreadPoolExecutor
 from embedding_service import EmbeddingService
 from vector_db_service import VectorDBService
 from exact_match_service import ExactMatchService
@@ -21,6 +23,8 @@ class DocumentProcessor:
         self.vector_db_service = VectorDBService()
         self.exact_match_service = ExactMatchService()
         self.section_chunker = SectionChunker()
+        # Runs per-document stages that don't depend on each other side by side
+        self.stage_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='doc-stage')
     
     def extract_text(self, filepath: str) -> Optional[Dict]:
         """
@@ -67,6 +71,7 @@ class DocumentProcessor:
             return {
                 "filename": filename,
                 "filepath": filepath,
+                "file_sha256": self._file_fingerprint(filepath),
                 "text_content": text_content,
                 "word_count": len(text_content.split()),
                 "char_count": len(text_content),
@@ -79,6 +84,16 @@ class DocumentProcessor:
             logger.error(f"Error extracting text from {filepath}: {str(e)}")
             return None
     
+    def _file_fingerprint(self, filepath: str) -> str:
+        """SHA-256 of the raw file, streamed through OpenSSL without loading it into memory"""
+        with open(filepath, 'rb') as file:
+            if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+                return hashlib.file_digest(file, 'sha256').hexdigest()
+            digest = hashlib.sha256()
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+            return digest.hexdigest()
+    
     def _extract_pdf_text(self, filepath: str) -> str:
         """Extract text from PDF file using multiple methods"""
         text = ""
@@ -195,12 +210,17 @@ class DocumentProcessor:
             if not doc_data:
                 raise ValueError(f"Failed to extract text from {filepath}")
             
-            # Create chunks with embeddings (using section-based embedding service)
-            chunks_with_embeddings = self.embedding_service.create_chunks_with_embeddings(
-                doc_data['text_content'], 
+            # Section hashing for exact matching doesn't need the embeddings, so it
+            # runs while the vector database encodes (the model releases the GIL)
+            section_chunks_future = self.stage_executor.submit(
+                self.section_chunker.create_section_chunks,
+                doc_data['text_content'],
                 doc_data['filename']
             )
             
+            # Chunks with embeddings were already created by extract_text
+            chunks_with_embeddings = doc_data['chunks']
+            
             if not chunks_with_embeddings:
                 raise ValueError(f"Failed to create chunks for {doc_data['filename']}")
             
@@ -216,6 +236,7 @@ class DocumentProcessor:
                         'word_count': len(chunk_data['text'].split()) if chunk_data['text'] else 0,
                         'chunk_type': 'semantic',
                         'file_extension': os.path.splitext(filepath)[1],
+                        'file_sha256': doc_data['file_sha256'],
                         'processing_timestamp': doc_data.get('processing_timestamp')
                     }
                 }
@@ -228,7 +249,7 @@ class DocumentProcessor:
             )
             
             # Add chunks to exact matching service (use section-based chunks with hashes)
-            section_chunks = self.section_chunker.create_section_chunks(doc_data['text_content'], doc_data['filename'])
+            section_chunks = section_chunks_future.result()
             self.exact_match_service.add_document_chunks(
                 document_name=doc_data['filename'],
                 chunks=section_chunks
@@ -1,23 +1,88 @@
 import os
 import logging
 import re
+import queue
+import threading
+import time
+import hashlib
+import bisect
+from collections import OrderedDict
+from concurrent.futures import Future
 from typing import List, Dict, Tuple, Optional
 import numpy as np
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.cluster import DBSCAN
+from scipy.sparse import csr_matrix
 import json
 from section_chunker import SectionChunker
 
+try:
+    import faiss
+except ImportError:  # Clustering falls back to sklearn's brute-force cosine DBSCAN
+    faiss = None
+
 logger = logging.getLogger(__name__)
 
+PERIOD_PATTERN = re.compile(r'\.')
+WORD_PATTERN = re.compile(r'\S+')
+
+class _EmbedBatcher:
+    """Coalesce encode requests from concurrent callers into shared forward passes"""
+    
+    def __init__(self, encode_fn, max_batch: int = 128, max_wait: float = 0.025):
+        self.encode_fn = encode_fn
+        self.max_batch = max_batch  # Flush once this many texts are pending
+        self.max_wait = max_wait  # Seconds to wait for more callers before flushing
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+    
+    def encode(self, texts: List[str]) -> Future:
+        """Queue texts for encoding; the future resolves to their embeddings"""
+        future = Future()
+        self._queue.put((texts, future))
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            pending = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            
+            # Drain whatever else arrives before the deadline or the batch fills up
+            while pending < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                pending += len(item[0])
+            
+            flat_texts = [text for texts, _ in batch for text in texts]
+            try:
+                embeddings = self.encode_fn(flat_texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            # Route each caller's slice of the batch back to it
+            offset = 0
+            for texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(texts)])
+                offset += len(texts)
+
 class EmbeddingService:
     """Service for processing documents using section-based embeddings"""
     
     def __init__(self):
         # Use a lightweight but effective model for embeddings
         self.model_name = "all-MiniLM-L6-v2"  # Fast and good quality
-        self.model = SentenceTransformer(self.model_name)
+        self._model = None  # Loaded on first use, see the model property
+        self._model_lock = threading.Lock()
         
         # Initialize section-based chunker
         self.section_chunker = SectionChunker()
@@ -27,8 +92,31 @@ class EmbeddingService:
         self.chunk_overlap = 100  # Overlap between chunks
         self.min_chunk_size = 50  # Minimum chunk size
         
+        # LRU cache of embeddings keyed by normalized-text digest; SOPs repeat
+        # boilerplate sections verbatim, so many chunks never hit the model
+        self.embedding_cache_size = 50000
+        self._embedding_cache = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        
+        # Concurrent uploads share forward passes through the batcher
+        self._batcher = _EmbedBatcher(
+            lambda texts: self.model.encode(
+                texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+            )
+        )
+        
         logger.info(f"Initialized embedding service with model: {self.model_name} and section-based chunking")
     
+    @property
+    def model(self) -> SentenceTransformer:
+        """The SentenceTransformer, loaded on first access so startup isn't blocked"""
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    self._model = SentenceTransformer(self.model_name)
+                    logger.info(f"Loaded embedding model: {self.model_name}")
+        return self._model
+    
     def create_embeddings(self, texts: List[str]) -> np.ndarray:
         """
         Generate embeddings for a list of texts
@@ -43,12 +131,46 @@ class EmbeddingService:
             return np.array([])
         
         try:
-            embeddings = self.model.encode(texts)
-            return embeddings
+            return self._encode(texts)
         except Exception as e:
             logger.error(f"Error generating embeddings: {str(e)}")
             return np.array([])
     
+    @staticmethod
+    def _embedding_cache_key(text: str) -> bytes:
+        """Cache key for a text (the model is uncased and ignores outer whitespace)"""
+        return hashlib.blake2b(text.strip().lower().encode('utf-8'), digest_size=16).digest()
+    
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts, serving repeats from the LRU cache and batching the rest"""
+        keys = [self._embedding_cache_key(text) for text in texts]
+        
+        with self._embedding_cache_lock:
+            found = {}
+            for key in keys:
+                if key in self._embedding_cache:
+                    self._embedding_cache.move_to_end(key)
+                    found[key] = self._embedding_cache[key]
+        
+        # Encode each distinct missing text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        
+        if missing:
+            encoded = self._batcher.encode(list(missing.values())).result()
+            # Copy rows so cache entries don't pin the whole batch array
+            found.update((key, np.array(row)) for key, row in zip(missing.keys(), encoded))
+            
+            with self._embedding_cache_lock:
+                for key in missing:
+                    self._embedding_cache[key] = found[key]
+                while len(self._embedding_cache) > self.embedding_cache_size:
+                    self._embedding_cache.popitem(last=False)
+        
+        return np.stack([found[key] for key in keys])
+    
     def create_chunks_with_embeddings(self, text_content: str, filename: str) -> List[Dict]:
         """
         Main method to create chunks with embeddings - tries section-based first
@@ -74,11 +196,12 @@ class EmbeddingService:
             
             # Generate embeddings for section chunks
             chunk_texts = [chunk['text'] for chunk in section_chunks]
-            embeddings = self.model.encode(chunk_texts, convert_to_numpy=True)
+            quantized, scales = self._quantize_embeddings(self._encode(chunk_texts))
             
             # Add embeddings to chunks
             for i, chunk in enumerate(section_chunks):
-                chunk['embedding'] = embeddings[i].tolist()
+                chunk['embedding'] = quantized[i]
+                chunk['embedding_scale'] = float(scales[i])
                 chunk['metadata']['embedding_model'] = self.model_name
                 chunk['metadata']['global_chunk_id'] = i
                 chunk['metadata']['chunk_id'] = f"{filename}_{i}"
@@ -118,60 +241,55 @@ class EmbeddingService:
                 }
                 
                 # Generate embedding
-                embedding = self.model.encode([cleaned_text], convert_to_numpy=True)
-                chunk['embedding'] = embedding[0].tolist()
+                quantized, scales = self._quantize_embeddings(self._encode([cleaned_text]))
+                chunk['embedding'] = quantized[0]
+                chunk['embedding_scale'] = float(scales[0])
                 
                 return [chunk]
             
             # Create multiple chunks using sliding window approach
-            chunks = []
-            start = 0
-            chunk_index = 0
+            window_bounds = self._sliding_window_bounds(cleaned_text)
             
-            while start < len(cleaned_text):
-                # Determine end position
-                end = min(start + self.chunk_size, len(cleaned_text))
-                
-                # Try to break at sentence boundary if possible
-                if end < len(cleaned_text):
-                    # Look for sentence end within overlap range
-                    break_point = cleaned_text.rfind('.', start, end - self.chunk_overlap)
-                    if break_point > start:
-                        end = break_point + 1
-                
+            # Word spans let each window's word count be found by binary search
+            word_spans = np.array([m.span() for m in WORD_PATTERN.finditer(cleaned_text)], dtype=np.int64).reshape(-1, 2)
+            starts = np.array([start for start, _ in window_bounds], dtype=np.int64)
+            ends = np.array([end for _, end in window_bounds], dtype=np.int64)
+            word_counts = (np.searchsorted(word_spans[:, 0], ends, side='left')
+                           - np.searchsorted(word_spans[:, 1], starts, side='right'))
+            
+            windows = []
+            for (start, end), word_count in zip(window_bounds, word_counts):
                 chunk_text = cleaned_text[start:end].strip()
-                
                 if len(chunk_text) >= self.min_chunk_size:
-                    chunk = {
-                        'text': chunk_text,
-                        'metadata': {
-                            'start_char': start,
-                            'end_char': end,
-                            'char_count': len(chunk_text),
-                            'word_count': len(chunk_text.split()),
-                            'chunk_index': chunk_index,
-                            'chunk_type': 'size_based_fallback',
-                            'filename': filename,
-                            'embedding_model': self.model_name,
-                            'global_chunk_id': chunk_index,
-                            'chunk_id': f"{filename}_{chunk_index}"
-                        }
+                    windows.append((start, end, chunk_text, int(word_count)))
+            
+            chunks = [
+                {
+                    'text': chunk_text,
+                    'metadata': {
+                        'start_char': start,
+                        'end_char': end,
+                        'char_count': len(chunk_text),
+                        'word_count': word_count,
+                        'chunk_index': chunk_index,
+                        'chunk_type': 'size_based_fallback',
+                        'filename': filename,
+                        'embedding_model': self.model_name,
+                        'global_chunk_id': chunk_index,
+                        'chunk_id': f"{filename}_{chunk_index}"
                     }
-                    chunks.append(chunk)
-                    chunk_index += 1
-                
-                # Move start position for next chunk
-                start = end - self.chunk_overlap
-                if start >= len(cleaned_text):
-                    break
+                }
+                for chunk_index, (start, end, chunk_text, word_count) in enumerate(windows)
+            ]
             
             # Generate embeddings for all chunks
             if chunks:
                 chunk_texts = [chunk['text'] for chunk in chunks]
-                embeddings = self.model.encode(chunk_texts, convert_to_numpy=True)
+                quantized, scales = self._quantize_embeddings(self._encode(chunk_texts))
                 
                 for i, chunk in enumerate(chunks):
-                    chunk['embedding'] = embeddings[i].tolist()
+                    chunk['embedding'] = quantized[i]
+                    chunk['embedding_scale'] = float(scales[i])
             
             logger.info(f"Created {len(chunks)} fallback chunks for {filename}")
             return chunks
@@ -180,6 +298,35 @@ class EmbeddingService:
             logger.error(f"Error in fallback chunking for {filename}: {str(e)}")
             return []
     
+    def _sliding_window_bounds(self, text: str) -> List[Tuple[int, int]]:
+        """
+        Compute (start, end) offsets of the fallback sliding windows, preferring
+        to end each window just after a sentence-ending period
+        """
+        periods = [m.start() for m in PERIOD_PATTERN.finditer(text)]
+        text_length = len(text)
+        bounds = []
+        start = 0
+        
+        while start < text_length:
+            end = min(start + self.chunk_size, text_length)
+            
+            # Break at the last period before the overlap region, if any
+            if end < text_length:
+                candidate = bisect.bisect_left(periods, end - self.chunk_overlap) - 1
+                if candidate >= 0 and periods[candidate] > start:
+                    end = periods[candidate] + 1
+            
+            bounds.append((start, end))
+            if end >= text_length:
+                break
+            
+            # Overlap with the previous window, but always move forward
+            next_start = end - self.chunk_overlap
+            start = next_start if next_start > start else end
+        
+        return bounds
+    
     def get_document_structure(self, chunks: List[Dict]) -> Dict:
         """
         Get hierarchical structure information from section-based chunks
@@ -190,6 +337,34 @@ class EmbeddingService:
             logger.error(f"Error getting document structure: {str(e)}")
             return {"error": "Could not determine document structure"}
     
+    @staticmethod
+    def _quantize_embeddings(embeddings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Quantize embeddings to int8 with one float32 scale per vector
+        
+        The encoder already L2-normalizes, so dequantized vectors stay (nearly)
+        unit length and cosine similarity is a plain dot product.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+        return quantized, scales
+    
+    @staticmethod
+    def _embedding_matrix(chunks: List[Dict]) -> np.ndarray:
+        """Stack (and dequantize) chunk embeddings into a float32 matrix"""
+        matrix = np.stack([chunk['embedding'] for chunk in chunks]).astype(np.float32)
+        scales = np.array([chunk.get('embedding_scale', 1.0) for chunk in chunks], dtype=np.float32)
+        return matrix * scales[:, None]
+    
+    @staticmethod
+    def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+        """L2-normalize each row, leaving all-zero rows untouched"""
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+    
     def calculate_similarity(self, chunks1: List[Dict], chunks2: List[Dict]) -> Dict:
         """
         Calculate similarity between two sets of chunks
@@ -199,81 +374,134 @@ class EmbeddingService:
                 return {"similarity_score": 0.0, "error": "Empty chunk sets"}
             
             # Get embeddings
-            embeddings1 = np.array([chunk['embedding'] for chunk in chunks1])
-            embeddings2 = np.array([chunk['embedding'] for chunk in chunks2])
+            embeddings1 = self._embedding_matrix(chunks1)
+            embeddings2 = self._embedding_matrix(chunks2)
             
             # Calculate average embeddings for each document
             avg_embedding1 = np.mean(embeddings1, axis=0)
             avg_embedding2 = np.mean(embeddings2, axis=0)
             
-            # Calculate cosine similarity
-            similarity = cosine_similarity([avg_embedding1], [avg_embedding2])[0][0]
-            
-            # Also calculate chunk-level similarities for detailed analysis
-            chunk_similarities = []
-            for i, emb1 in enumerate(embeddings1):
-                for j, emb2 in enumerate(embeddings2):
-                    sim = cosine_similarity([emb1], [emb2])[0][0]
-                    chunk_similarities.append({
-                        'chunk1_index': i,
-                        'chunk2_index': j,
-                        'similarity': float(sim),
-                        'chunk1_section': chunks1[i]['metadata'].get('section_title', 'Unknown'),
-                        'chunk2_section': chunks2[j]['metadata'].get('section_title', 'Unknown')
-                    })
-            
-            # Sort by similarity score
-            chunk_similarities.sort(key=lambda x: x['similarity'], reverse=True)
+            # Calculate cosine similarity (averages of unit vectors are not unit length)
+            similarity = np.dot(*self._normalize_rows(np.stack([avg_embedding1, avg_embedding2])))
+            
+            # Chunk-level similarities for detailed analysis, as one matrix product
+            chunk_similarities = embeddings1 @ embeddings2.T
+            
+            # Top 10 most similar chunk pairs, highest first (ties in row-major order)
+            flat_similarities = chunk_similarities.ravel()
+            top_count = min(10, flat_similarities.size)
+            top_indices = np.argpartition(-flat_similarities, top_count - 1)[:top_count]
+            top_indices = top_indices[np.lexsort((top_indices, -flat_similarities[top_indices]))]
+            
+            top_similar_chunks = []
+            for flat_index in top_indices:
+                i, j = divmod(int(flat_index), chunk_similarities.shape[1])
+                top_similar_chunks.append({
+                    'chunk1_index': i,
+                    'chunk2_index': j,
+                    'similarity': float(flat_similarities[flat_index]),
+                    'chunk1_section': chunks1[i]['metadata'].get('section_title', 'Unknown'),
+                    'chunk2_section': chunks2[j]['metadata'].get('section_title', 'Unknown')
+                })
             
             return {
                 "similarity_score": float(similarity),
                 "chunk_count_1": len(chunks1),
                 "chunk_count_2": len(chunks2),
-                "top_similar_chunks": chunk_similarities[:10],  # Top 10 most similar chunk pairs
-                "avg_chunk_similarity": float(np.mean([cs['similarity'] for cs in chunk_similarities]))
+                "top_similar_chunks": top_similar_chunks,
+                "avg_chunk_similarity": float(chunk_similarities.mean())
             }
             
         except Exception as e:
             logger.error(f"Error calculating similarity: {str(e)}")
             return {"similarity_score": 0.0, "error": str(e)}
     
-    def cluster_chunks(self, all_chunks: List[Dict], eps: float = 0.3, min_samples: int = 2) -> Dict:
+    def _neighbor_graph(self, embeddings: np.ndarray, eps: float, k: int) -> csr_matrix:
+        """
+        Sparse cosine-distance graph holding only pairs within eps
+        
+        A FAISS k-nearest-neighbour search covers most points; only points
+        whose k-th neighbour is still within eps (so their neighbourhood was
+        cut short) are re-queried with a range search, keeping the graph exact.
+        """
+        vectors = np.ascontiguousarray(self._normalize_rows(embeddings), dtype=np.float32)
+        index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(vectors)
+        
+        k = min(k, len(vectors))
+        similarities, neighbors = index.search(vectors, k)
+        within_eps = similarities >= 1.0 - eps
+        truncated = np.flatnonzero(within_eps[:, -1]) if k < len(vectors) else np.array([], dtype=np.int64)
+        within_eps[truncated] = False
+        
+        rows = [np.nonzero(within_eps)[0]]
+        cols = [neighbors[within_eps]]
+        sims = [similarities[within_eps]]
+        
+        if len(truncated):
+            limits, range_sims, range_neighbors = index.range_search(vectors[truncated], 1.0 - eps)
+            rows.append(np.repeat(truncated, np.diff(limits).astype(np.int64)))
+            cols.append(range_neighbors)
+            sims.append(range_sims)
+        
+        distances = np.clip(1.0 - np.concatenate(sims), 0.0, None)
+        return csr_matrix(
+            (distances, (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(vectors), len(vectors))
+        )
+    
+    @staticmethod
+    def _chunk_preview(index: int, chunk: Dict) -> Dict:
+        """Summary of a chunk for clustering results"""
+        text = chunk['text']
+        metadata = chunk['metadata']
+        return {
+            'chunk_index': int(index),
+            'text_preview': text if len(text) <= 100 else text[:100] + "...",
+            'section_title': metadata.get('section_title', 'Unknown'),
+            'filename': metadata.get('filename', 'Unknown')
+        }
+    
+    def cluster_chunks(self, all_chunks: List[Dict], eps: float = 0.3, min_samples: int = 2,
+                       neighbors_per_chunk: Optional[int] = None, max_noise_points: Optional[int] = None) -> Dict:
         """
         Cluster chunks using DBSCAN based on their embeddings
+        
+        neighbors_per_chunk sizes the kNN search used to build the neighbour
+        graph (defaults to 4 * min_samples); it affects speed, not the result.
+        max_noise_points caps how many noise points are listed (all by default).
         """
         try:
             if len(all_chunks) < 2:
                 return {"clusters": [], "noise_points": [], "cluster_count": 0}
             
             # Get embeddings
-            embeddings = np.array([chunk['embedding'] for chunk in all_chunks])
+            embeddings = self._embedding_matrix(all_chunks)
             
             # Perform clustering
-            clustering = DBSCAN(eps=eps, min_samples=min_samples, metric='cosine')
-            cluster_labels = clustering.fit_predict(embeddings)
+            if faiss is not None:
+                clustering = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed')
+                graph = self._neighbor_graph(embeddings, eps, neighbors_per_chunk or min_samples * 4)
+                cluster_labels = clustering.fit_predict(graph)
+            else:
+                clustering = DBSCAN(eps=eps, min_samples=min_samples, metric='cosine')
+                cluster_labels = clustering.fit_predict(embeddings)
             
-            # Organize results
+            # Organize results; previews are only built for points that are reported
             clusters = {}
-            noise_points = []
-            
-            for i, label in enumerate(cluster_labels):
-                chunk_info = {
-                    'chunk_index': i,
-                    'text_preview': all_chunks[i]['text'][:100] + "..." if len(all_chunks[i]['text']) > 100 else all_chunks[i]['text'],
-                    'section_title': all_chunks[i]['metadata'].get('section_title', 'Unknown'),
-                    'filename': all_chunks[i]['metadata'].get('filename', 'Unknown')
-                }
-                
-                if label == -1:  # Noise point
-                    noise_points.append(chunk_info)
-                else:
-                    if label not in clusters:
-                        clusters[label] = []
-                    clusters[label].append(chunk_info)
+            for i in np.flatnonzero(cluster_labels != -1):
+                clusters.setdefault(int(cluster_labels[i]), []).append(self._chunk_preview(i, all_chunks[i]))
+            
+            noise_indices = np.flatnonzero(cluster_labels == -1)
+            noise_points = [
+                self._chunk_preview(i, all_chunks[i])
+                for i in noise_indices[:max_noise_points]
+            ]
             
             return {
                 "clusters": [{"cluster_id": k, "chunks": v} for k, v in clusters.items()],
                 "noise_points": noise_points,
+                "noise_count": len(noise_indices),
                 "cluster_count": len(clusters)
             }
             
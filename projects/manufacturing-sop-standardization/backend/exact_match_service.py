@@ -3,6 +3,7 @@ import json
 import os
 from typing import List, Dict, Any, Set, Optional
 from collections import defaultdict
+from section_chunker import SENTENCE_HASH_TYPE
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +20,9 @@ class ExactMatchService:
         # Document to sentence hashes mapping
         self.document_to_sentence_hashes: Dict[str, Set[str]] = defaultdict(set)
         
+        # Bumped whenever the index changes, so callers can key caches on it
+        self.revision = 0
+        
         # Persistence file
         self.persistence_file = "./exact_match_data.json"
         
@@ -77,6 +81,7 @@ class ExactMatchService:
                         self.sentence_hash_to_documents[sentence_hash].append(sentence_ref)
                         self.document_to_sentence_hashes[document_name].add(sentence_hash)
             
+            self.revision += 1
             logger.info(f"Added {len(chunks)} chunks with sentence-level hashes from '{document_name}' to exact match index")
             
             # Save data to persistence file
@@ -409,6 +414,7 @@ class ExactMatchService:
             
             # Remove from document mapping
             del self.document_to_hashes[document_name]
+            self.revision += 1
             
             logger.info(f"Removed {removed_count} chunks for document '{document_name}' from exact match index")
             return removed_count
@@ -426,16 +432,22 @@ class ExactMatchService:
                 
                 # Convert back to defaultdicts and sets
                 self.hash_to_documents = defaultdict(list, data.get('hash_to_documents', {}))
-                self.sentence_hash_to_documents = defaultdict(list, data.get('sentence_hash_to_documents', {}))
                 
                 # Convert sets back from lists
                 self.document_to_hashes = defaultdict(set)
                 for doc, hashes in data.get('document_to_hashes', {}).items():
                     self.document_to_hashes[doc] = set(hashes)
                 
-                self.document_to_sentence_hashes = defaultdict(set)
-                for doc, hashes in data.get('document_to_sentence_hashes', {}).items():
-                    self.document_to_sentence_hashes[doc] = set(hashes)
+                # Sentence hashes from an older hash scheme can never match new
+                # documents, so they are dropped rather than loaded
+                if data.get('sentence_hash_type', 'sha256') == SENTENCE_HASH_TYPE:
+                    self.sentence_hash_to_documents = defaultdict(list, data.get('sentence_hash_to_documents', {}))
+                    
+                    self.document_to_sentence_hashes = defaultdict(set)
+                    for doc, hashes in data.get('document_to_sentence_hashes', {}).items():
+                        self.document_to_sentence_hashes[doc] = set(hashes)
+                else:
+                    logger.warning("Discarding sentence hashes from an older hash scheme; re-upload documents to restore sentence-level matching")
                 
                 logger.info(f"Loaded exact match data from {self.persistence_file}")
             else:
@@ -452,7 +464,8 @@ class ExactMatchService:
                 'hash_to_documents': dict(self.hash_to_documents),
                 'sentence_hash_to_documents': dict(self.sentence_hash_to_documents),
                 'document_to_hashes': {doc: list(hashes) for doc, hashes in self.document_to_hashes.items()},
-                'document_to_sentence_hashes': {doc: list(hashes) for doc, hashes in self.document_to_sentence_hashes.items()}
+                'document_to_sentence_hashes': {doc: list(hashes) for doc, hashes in self.document_to_sentence_hashes.items()},
+                'sentence_hash_type': SENTENCE_HASH_TYPE
             }
             
             with open(self.persistence_file, 'w') as f:
@@ -0,0 +1,18 @@
+"""
+Gunicorn configuration for running the backend in production:
+
+    gunicorn -c gunicorn_conf.py app:app
+
+Job status, the comparison cache and the exact-match index live in process
+memory, so a single worker process is used and concurrency comes from
+threads. Embedding work runs on the app's own bounded executor, and the
+model releases the GIL, so blocking file I/O overlaps with it.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8001)}"
+workers = 1
+worker_class = 'gthread'
+threads = int(os.environ.get('SOP_HTTP_THREADS', (os.cpu_count() or 1) * 4))
+timeout = 120
+keepalive = 5
@@ -1,11 +1,42 @@
 import re
 import logging
 import hashlib
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Optional, Tuple, Iterator
 from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
+# Section header formats, fused into one pattern that is run over the whole
+# document at once. Headers may be indented; [^\S\n] is whitespace that
+# stays on the same line. Every alternative is wrapped in a named group
+# (which closes last, so it is the match's lastgroup) followed by its
+# (number, title) groups.
+SECTION_HEADER_PATTERN = re.compile(r"""
+    ^[^\S\n]*(?:
+        # Numbered sections: 1., 2., 3. (with space after period)
+        (?P<numbered>(\d+)\.[^\S\n]+(.+))
+        # Subsections and sub-subsections: 1.1, 2.1, 1.1.1 (with or without period)
+      | (?P<subsection>(\d+\.\d+(?:\.\d+)?)\.?[^\S\n]+(.+))
+        # Letter sections: A., B., C.
+      | (?P<letter>([A-Z])\.[^\S\n]+(.+))
+        # Roman numerals: I., II., III.
+      | (?P<roman>([IVX]+)\.[^\S\n]+(.+))
+        # Alternative formats: Section 1, SECTION 1:
+      | (?P<keyword>SECTION[^\S\n]+(\d+):?[^\S\n]+(.+))
+      | (?P<paren_number>(\d+)\)[^\S\n]+(.+))  # 1) format
+      | (?P<paren_letter>([a-z])\)[^\S\n]+(.+))  # a) format
+    )
+""", re.IGNORECASE | re.MULTILINE | re.VERBOSE)
+
+NUMERIC_TITLE_PATTERN = re.compile(r'^[\d\s\.\-_]+$')
+SENTENCE_PUNCTUATION = ('.', '!', '?')
+SENTENCE_PATTERN = re.compile(r'[^.!?]+')
+SENTENCE_BREAK_PATTERN = re.compile(r'[.!?]+\s+')
+# Sentence hashes only need to be unique within the exact-match index, so a
+# 64-bit BLAKE2b digest is used instead of SHA-256 (a quarter of the size)
+SENTENCE_HASH_TYPE = 'blake2b_64'
+
+
 @dataclass
 class Section:
     """Represents a document section or subsection"""
@@ -21,25 +52,6 @@ class SectionChunker:
     """Advanced section-wise chunking for SOP documents"""
     
     def __init__(self):
-        # Patterns for detecting different section formats
-        self.section_patterns = [
-            # Numbered sections: 1., 2., 3. (with space after period)
-            r'^(\d+)\.\s+(.+)',
-            # Subsections: 1.1, 1.2, 2.1 (with or without period)
-            r'^(\d+\.\d+)\.?\s+(.+)',
-            # Sub-subsections: 1.1.1, 1.1.2
-            r'^(\d+\.\d+\.\d+)\.?\s+(.+)',
-            # Letter sections: A., B., C.
-            r'^([A-Z])\.\s+(.+)',
-            # Roman numerals: I., II., III.
-            r'^([IVX]+)\.\s+(.+)',
-            # Alternative formats
-            r'^Section\s+(\d+):?\s+(.+)',
-            r'^SECTION\s+(\d+):?\s+(.+)',
-            r'^(\d+)\)\s+(.+)',  # 1) format
-            r'^([a-z])\)\s+(.+)',  # a) format
-        ]
-        
         # Common SOP section keywords
         self.sop_keywords = [
             'purpose', 'scope', 'responsibility', 'procedure', 'materials',
@@ -49,9 +61,17 @@ class SectionChunker:
             'training', 'maintenance', 'troubleshooting', 'emergency',
             'procedures', 'background', 'overview', 'introduction'
         ]
+        # One alternation so a line is scanned once rather than once per keyword
+        self.sop_keyword_pattern = re.compile('|'.join(map(re.escape, self.sop_keywords)))
         
         logger.info("Initialized SectionChunker for SOP documents")
     
+    def _normalize_for_hashing(self, text: str) -> str:
+        """Lowercase text and collapse whitespace so formatting doesn't change hashes"""
+        # str.split() drops leading/trailing whitespace and splits on the same
+        # characters as \s, so this strips and collapses runs in one C pass
+        return ' '.join(text.lower().split())
+    
     def _generate_content_hash(self, text: str) -> str:
         """
         Generate SHA-256 hash for content-based exact matching
@@ -63,9 +83,7 @@ class SectionChunker:
             SHA-256 hash as hexadecimal string
         """
         # Normalize text for consistent hashing
-        normalized_text = text.strip().lower()
-        # Remove extra whitespace
-        normalized_text = re.sub(r'\s+', ' ', normalized_text)
+        normalized_text = self._normalize_for_hashing(text)
         
         # Generate hash
         content_hash = hashlib.sha256(normalized_text.encode('utf-8')).hexdigest()
@@ -81,26 +99,25 @@ class SectionChunker:
         Returns:
             List of sentence hash dictionaries
         """
-        # Split into sentences (simple approach)
-        sentences = re.split(r'[.!?]+', text)
         sentence_hashes = []
         
-        for i, sentence in enumerate(sentences):
-            sentence = sentence.strip()
+        # Walk the sentences between punctuation runs (simple approach). Indexes
+        # count every fragment, including the empty one before leading punctuation.
+        sentence_index = 1 if text[:1] in SENTENCE_PUNCTUATION else 0
+        for match in SENTENCE_PATTERN.finditer(text):
+            sentence = match.group().strip()
             if len(sentence) > 10:  # Skip very short fragments
-                # Normalize sentence
-                normalized_sentence = sentence.lower().strip()
-                normalized_sentence = re.sub(r'\s+', ' ', normalized_sentence)
-                
                 # Generate hash
-                sentence_hash = hashlib.sha256(normalized_sentence.encode('utf-8')).hexdigest()
+                normalized_sentence = self._normalize_for_hashing(sentence)
+                sentence_hash = hashlib.blake2b(normalized_sentence.encode('utf-8'), digest_size=8).hexdigest()
                 
                 sentence_hashes.append({
-                    'sentence_index': i,
+                    'sentence_index': sentence_index,
                     'sentence_text': sentence,
                     'sentence_hash': sentence_hash,
                     'word_count': len(sentence.split())
                 })
+            sentence_index += 1
         
         return sentence_hashes
     
@@ -115,44 +132,41 @@ class SectionChunker:
             List of detected sections
         """
         sections = []
-        lines = text.split('\n')
+        sections_by_number: Dict[str, Section] = {}  # For parent lookups
         current_section = None
-        content_buffer = []
+        content_start = 0  # Character offset where the current section's content begins
         
-        for i, line in enumerate(lines):
-            line_stripped = line.strip()
+        # Scan the whole document for header lines in one pass
+        for match in SECTION_HEADER_PATTERN.finditer(text):
+            section_match = self._parse_section_header(match)
+            if not section_match:
+                continue
             
-            # Check if this line is a section header
-            section_match = self._match_section_header(line_stripped) if line_stripped else None
+            header_start = match.start()
             
-            if section_match:
-                # Save previous section if exists
-                if current_section:
-                    current_section.content = '\n'.join(content_buffer).strip()
-                    current_section.end_pos = self._get_text_position(text, i)
-                    sections.append(current_section)
-                
-                # Create new section
-                level, number, title = section_match
-                current_section = Section(
-                    level=level,
-                    number=number,
-                    title=title,
-                    content='',
-                    start_pos=self._get_text_position(text, i),
-                    end_pos=0,
-                    parent_section=self._find_parent_section(number, sections)
-                )
-                content_buffer = []
-                
-            else:
-                # Add line to current section content (including empty lines for structure)
-                if current_section:  # Only add if we have a current section
-                    content_buffer.append(line_stripped)
+            # Save previous section if exists
+            if current_section:
+                current_section.content = self._section_content(text, content_start, header_start)
+                current_section.end_pos = header_start
+                sections.append(current_section)
+            
+            # Create new section
+            level, number, title = section_match
+            current_section = Section(
+                level=level,
+                number=number,
+                title=title,
+                content='',
+                start_pos=header_start,
+                end_pos=0,
+                parent_section=self._find_parent_section(number, sections_by_number)
+            )
+            sections_by_number.setdefault(number, current_section)
+            content_start = match.end() + 1  # The title runs to the end of the line
         
         # Save the last section
         if current_section:
-            current_section.content = '\n'.join(content_buffer).strip()
+            current_section.content = self._section_content(text, content_start, len(text))
             current_section.end_pos = len(text)
             sections.append(current_section)
         
@@ -170,6 +184,10 @@ class SectionChunker:
         logger.info(f"Detected {len(sections)} sections in document")
         return sections
     
+    def _section_content(self, text: str, start: int, end: int) -> str:
+        """Slice a section's content out of the text, stripping each line"""
+        return '\n'.join([line.strip() for line in text[start:end].split('\n')]).strip()
+    
     def _match_section_header(self, line: str) -> Optional[Tuple[int, str, str]]:
         """
         Check if a line matches any section header pattern
@@ -177,17 +195,9 @@ class SectionChunker:
         Returns:
             Tuple of (level, number, title) if match found, None otherwise
         """
-        # Check numbered patterns first (most specific)
-        for pattern in self.section_patterns:
-            match = re.match(pattern, line, re.IGNORECASE)
-            if match:
-                number = match.group(1)
-                title = match.group(2).strip() if len(match.groups()) > 1 else line
-                level = self._determine_section_level(number)
-                
-                # Validate this looks like a real section
-                if self._is_valid_section(title):
-                    return (level, number, title)
+        match = SECTION_HEADER_PATTERN.match(line)
+        if match:
+            return self._parse_section_header(match)
         
         # Check for keyword-based sections (disabled for now to avoid false positives)
         # if self._contains_sop_keywords(line):
@@ -195,45 +205,47 @@ class SectionChunker:
         
         return None
     
-    def _determine_section_level(self, number: str) -> int:
-        """Determine the hierarchical level of a section"""
-        if re.match(r'^\d+$', number):  # 1, 2, 3
-            return 1
-        elif re.match(r'^\d+\.\d+$', number):  # 1.1, 1.2
-            return 2
-        elif re.match(r'^\d+\.\d+\.\d+$', number):  # 1.1.1, 1.1.2
-            return 3
-        elif re.match(r'^[A-Z]$', number):  # A, B, C
-            return 1
-        elif re.match(r'^[IVX]+$', number):  # I, II, III
-            return 1
-        elif re.match(r'^[a-z]$', number):  # a, b, c
-            return 2
-        else:
-            return 1
+    def _parse_section_header(self, match: re.Match) -> Optional[Tuple[int, str, str]]:
+        """
+        Extract a header from a section pattern match, if it looks like a real section
+        
+        Returns:
+            Tuple of (level, number, title) if valid, None otherwise
+        """
+        number_group = match.lastindex + 1
+        number = match.group(number_group)
+        title = match.group(number_group + 1).strip()
+        level = self._determine_section_level(match.lastgroup, number)
+        
+        # Validate this looks like a real section
+        if self._is_valid_section(title):
+            return (level, number, title)
+        
+        return None
+    
+    def _determine_section_level(self, header_type: str, number: str) -> int:
+        """Determine the hierarchical level of a section from the header format that matched"""
+        if header_type == 'subsection':  # 1.1 -> 2, 1.1.1 -> 3
+            return number.count('.') + 1
+        if header_type in ('letter', 'paren_letter'):  # a, b, c are subsections; A, B, C are sections
+            return 2 if 'a' <= number <= 'z' else 1
+        return 1  # 1, 2, 3 / I, II, III / Section 1
     
     def _is_valid_section(self, title: str) -> bool:
         """Check if a title looks like a valid section header"""
-        # Must have some meaningful content
-        if len(title.strip()) < 2:
-            return False
-        
-        # Should not be too long (likely not a header)
-        if len(title) > 100:
+        # Cheap length bounds first: should not be too long (likely not a
+        # header) and must have some meaningful content
+        if len(title) > 100 or len(title.strip()) < 2:
             return False
         
         # Should not be all numbers or special characters
-        if re.match(r'^[\d\s\.\-_]+$', title):
-            return False
-        
-        return True
+        return NUMERIC_TITLE_PATTERN.match(title) is None
     
     def _contains_sop_keywords(self, line: str) -> bool:
         """Check if line contains SOP-specific keywords"""
-        line_lower = line.lower()
-        return any(keyword in line_lower for keyword in self.sop_keywords)
+        return self.sop_keyword_pattern.search(line.lower()) is not None
     
-    def _find_parent_section(self, number: str, existing_sections: List[Section]) -> Optional[str]:
+    def _find_parent_section(self, number: str, sections_by_number: Dict[str, Section]) -> Optional[str]:
         """Find the parent section for hierarchical numbering"""
         if '.' in number and number != "auto":
             # For 1.1, parent is 1
@@ -242,19 +254,10 @@ class SectionChunker:
             if len(parts) > 1:
                 parent_number = '.'.join(parts[:-1])
                 # Check if parent section exists
-                for section in existing_sections:
-                    if section.number == parent_number:
-                        return parent_number
+                if parent_number in sections_by_number:
+                    return parent_number
         return None
     
-    def _get_text_position(self, text: str, line_index: int) -> int:
-        """Get character position in text from line index"""
-        lines = text.split('\n')
-        position = 0
-        for i in range(min(line_index, len(lines))):
-            position += len(lines[i]) + 1  # +1 for newline
-        return position
-    
     def create_section_chunks(self, text: str, filename: str) -> List[Dict[str, Any]]:
         """
         Create chunks based on detected sections
@@ -266,8 +269,23 @@ class SectionChunker:
         Returns:
             List of chunk dictionaries with section metadata
         """
+        chunks = list(self.iter_section_chunks(text, filename))
+        
+        logger.info(f"Created {len(chunks)} section-based chunks for {filename}")
+        return chunks
+    
+    def iter_section_chunks(self, text: str, filename: str) -> Iterator[Dict[str, Any]]:
+        """
+        Lazily create chunks based on detected sections, one section at a time
+        
+        Args:
+            text: Document text content
+            filename: Name of the source document
+            
+        Yields:
+            Chunk dictionaries with section metadata
+        """
         sections = self.detect_sections(text)
-        chunks = []
         
         for i, section in enumerate(sections):
             # Skip very small sections (likely headers only)
@@ -301,19 +319,12 @@ class SectionChunker:
                     'sentence_count': len(sentence_hashes)
                 }
             }
-            chunks.append(chunk)
-        
-        # If sections are too large, further subdivide them
-        refined_chunks = []
-        for chunk in chunks:
+            
+            # If the section is too large, further subdivide it
             if chunk['metadata']['char_count'] > 2000:  # Large section
-                sub_chunks = self._subdivide_large_section(chunk)
-                refined_chunks.extend(sub_chunks)
+                yield from self._subdivide_large_section(chunk)
             else:
-                refined_chunks.append(chunk)
-        
-        logger.info(f"Created {len(refined_chunks)} section-based chunks for {filename}")
-        return refined_chunks
+                yield chunk
     
     def _subdivide_large_section(self, chunk: Dict[str, Any]) -> List[Dict[str, Any]]:
         """
@@ -327,18 +338,29 @@ class SectionChunker:
         
         if len(paragraphs) <= 1:
             # No clear paragraphs, split by sentences
-            sentences = re.split(r'[.!?]+\s+', content)
+            sentences = SENTENCE_BREAK_PATTERN.split(content)
             paragraphs = []
-            current_para = ""
+            current_sentences = []
+            current_length = 0  # Length of the paragraph so far, including ". " separators
             for sentence in sentences:
-                if len(current_para + sentence) < 1000:
-                    current_para += sentence + ". "
+                if current_length + len(sentence) < 1000:
+                    current_sentences.append(sentence)
+                    current_length += len(sentence) + 2
                 else:
-                    if current_para:
-                        paragraphs.append(current_para.strip())
-                    current_para = sentence + ". "
-            if current_para:
-                paragraphs.append(current_para.strip())
+                    if current_sentences:
+                        paragraphs.append(('. '.join(current_sentences) + '.').strip())
+                    current_sentences = [sentence]
+                    current_length = len(sentence) + 2
+            if current_sentences:
+                paragraphs.append(('. '.join(current_sentences) + '.').strip())
+        
+        # Fields shared by every sub-chunk are merged into the parent metadata once
+        subdivision_metadata = {
+            **metadata,
+            'chunk_type': 'section_subdivision',
+            'hash_type': 'content'
+        }
+        parent_chunk_index = metadata['chunk_index']
         
         # Create sub-chunks
         sub_chunks = []
@@ -353,14 +375,12 @@ class SectionChunker:
                 'text': para,
                 'content_hash': sub_content_hash,
                 'metadata': {
-                    **metadata,
-                    'chunk_index': f"{metadata['chunk_index']}.{i}",
+                    **subdivision_metadata,
+                    'chunk_index': f"{parent_chunk_index}.{i}",
                     'sub_chunk_index': i,
                     'char_count': len(para),
                     'word_count': len(para.split()),
-                    'chunk_type': 'section_subdivision',
-                    'content_hash': sub_content_hash,
-                    'hash_type': 'content'
+                    'content_hash': sub_content_hash
                 }
             }
             sub_chunks.append(sub_chunk)
@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 import uuid
 from typing import List, Dict, Any, Optional
 import chromadb
@@ -19,14 +20,26 @@ class VectorDBService:
         # Initialize ChromaDB client
         self.client = chromadb.PersistentClient(path=persist_directory)
         
-        # Initialize embedding model (same as embedding_service for consistency)
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        # Embedding model (same as embedding_service for consistency), loaded on first use
+        self.embedding_model_name = 'all-MiniLM-L6-v2'
+        self._embedding_model = None
+        self._embedding_model_lock = threading.Lock()
         
         # Track document collections
         self.document_collections = {}
         
         logger.info(f"Initialized VectorDB service with persistence at: {persist_directory}")
     
+    @property
+    def embedding_model(self) -> SentenceTransformer:
+        """The SentenceTransformer, loaded on first access so startup isn't blocked"""
+        if self._embedding_model is None:
+            with self._embedding_model_lock:
+                if self._embedding_model is None:
+                    self._embedding_model = SentenceTransformer(self.embedding_model_name)
+                    logger.info(f"Loaded embedding model: {self.embedding_model_name}")
+        return self._embedding_model
+    
     def _get_or_create_document_collection(self, document_name: str):
         """Get or create a collection for a specific document"""
         # Create a safe collection name that meets ChromaDB requirements:
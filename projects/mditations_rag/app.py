@@ -3,11 +3,12 @@ import os
 import logging
 from typing import Dict, Any
 import time
-import hashlib
+import glob
 
 from pdf_processor import PDFProcessor
 from vector_store import VectorStore
 from rag_engine import RAGEngine
+from utils import compute_file_hash
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -75,24 +76,58 @@ MODEL_OPTIONS = [
     ("DeepSeek R1 (deepseek/deepseek-r1:free)", "deepseek/deepseek-r1:free"),
 ]
 
+# Streamed answers are redrawn at most this often
+ANSWER_RENDER_INTERVAL_SECONDS = 0.05
+
+# Example questions paired with stable button keys, built once at import
+EXAMPLE_QUESTIONS = [
+    (f"example_{i}", question) for i, question in enumerate([
+        "What does Marcus Aurelius say about death?",
+        "How should one deal with anger according to the Meditations?",
+        "What is the Stoic view on external events?",
+        "How does Marcus Aurelius advise dealing with difficult people?",
+        "What does he say about living in the present moment?",
+        "How should one approach their duties and responsibilities?",
+        "What is the importance of reason in Stoic philosophy?",
+        "How does Marcus Aurelius view the nature of the universe?"
+    ])
+]
+
+@st.cache_data
+def get_pdf_hash(pdf_path: str, modified_time: float) -> str:
+    """Hash the PDF contents (recomputed only when the file changes on disk)."""
+    return compute_file_hash(pdf_path)
+
 @st.cache_resource
-def initialize_rag_system():
-    """Initialize the RAG system components."""
+def initialize_rag_system(pdf_path: str, pdf_hash: str):
+    """Initialize the RAG system components for a given version of the PDF."""
     try:
         # Check if vector store has documents
         vector_store = VectorStore()
         info = vector_store.get_collection_info()
         
-        if info["document_count"] == 0:
+        # A marker next to the database records which PDF it was built from,
+        # so restarts with the same PDF skip extraction and embedding
+        ingested_marker = os.path.join(vector_store.persist_directory, f".ingested_{pdf_hash}")
+        
+        if info["document_count"] == 0 or not os.path.exists(ingested_marker):
             st.info("First time setup: Processing PDF and creating vector database...")
             
+            # Drop chunks from an older version of the PDF
+            if info["document_count"] > 0:
+                vector_store.clear_collection()
+            
             # Process PDF
-            processor = PDFProcessor()
+            processor = PDFProcessor(pdf_path)
             documents = processor.process_pdf()
             
             # Add to vector store
             vector_store.add_documents(documents)
             
+            for stale_marker in glob.glob(os.path.join(vector_store.persist_directory, ".ingested_*")):
+                os.remove(stale_marker)
+            open(ingested_marker, 'w').close()
+            
             st.success("PDF processed and vector database created!")
         
         # Initialize RAG engine
@@ -149,7 +184,13 @@ def main():
     st.sidebar.info(f"Current model: {selected_model_label}")
 
     # Initialize RAG system
-    rag_engine = initialize_rag_system()
+    try:
+        pdf_path = PDFProcessor().pdf_path
+        pdf_hash = get_pdf_hash(pdf_path, os.path.getmtime(pdf_path))
+        rag_engine = initialize_rag_system(pdf_path, pdf_hash)
+    except OSError as e:
+        st.error(f"Error initializing RAG system: {e}")
+        rag_engine = None
     
     if rag_engine is None:
         st.error("Failed to initialize RAG system. Please check your setup.")
@@ -185,20 +226,7 @@ def main():
     with col2:
         st.markdown('<h3 class="sub-header">Example Questions</h3>', unsafe_allow_html=True)
         
-        example_questions = [
-            "What does Marcus Aurelius say about death?",
-            "How should one deal with anger according to the Meditations?",
-            "What is the Stoic view on external events?",
-            "How does Marcus Aurelius advise dealing with difficult people?",
-            "What does he say about living in the present moment?",
-            "How should one approach their duties and responsibilities?",
-            "What is the importance of reason in Stoic philosophy?",
-            "How does Marcus Aurelius view the nature of the universe?"
-        ]
-        
-        for question in example_questions:
-            # Use a hash of the question for a unique key
-            key = f"example_{hashlib.md5(question.encode()).hexdigest()}"
+        for key, question in EXAMPLE_QUESTIONS:
             if st.button(question, key=key):
                 st.session_state.query = question
                 st.rerun()
@@ -217,18 +245,34 @@ def process_query(query: str, n_context: int, rag_engine: RAGEngine, model: str)
         
         # Get answer
         start_time = time.time()
-        result = rag_engine.answer_question(query, n_context, model=model)
-        end_time = time.time()
+        result = rag_engine.answer_question_stream(query, n_context, model=model)
         
         # Update progress
-        progress_bar.progress(100)
-        status_text.text("Complete!")
+        progress_bar.progress(50)
+        status_text.text("Generating answer...")
         
         # Display results
         st.markdown('<h2 class="sub-header">Answer</h2>', unsafe_allow_html=True)
         
-        # Always show the answer in a visible, styled box
-        st.markdown(f'<div class="answer-box">{result["answer"]}</div>', unsafe_allow_html=True)
+        # Always show the answer in a visible, styled box, filled in as tokens arrive
+        answer_box = st.empty()
+        answer = ""
+        rendered_answer = None
+        last_render = 0.0
+        for token in result["answer_stream"]:
+            answer += token
+            # Each render re-sends the whole answer so far, so cap the refresh rate
+            if time.monotonic() - last_render >= ANSWER_RENDER_INTERVAL_SECONDS:
+                answer_box.markdown(f'<div class="answer-box">{answer}</div>', unsafe_allow_html=True)
+                rendered_answer = answer
+                last_render = time.monotonic()
+        if answer != rendered_answer:
+            answer_box.markdown(f'<div class="answer-box">{answer}</div>', unsafe_allow_html=True)
+        end_time = time.time()
+        
+        # Update progress
+        progress_bar.progress(100)
+        status_text.text("Complete!")
         
         # Metrics
         col1, col2, col3 = st.columns(3)
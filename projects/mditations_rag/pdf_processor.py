@@ -1,4 +1,4 @@
-import PyPDF2
+import pymupdf
 import os
 from typing import List, Dict, Any
 import logging
@@ -8,6 +8,9 @@ from utils import remove_end_of_page_footnotes
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Paragraph markers like 3.1, 3.2 at the start of a line
+PARAGRAPH_MARKER_PATTERN = re.compile(r'(\n|^)(\d+\.\d+)', re.MULTILINE)
+
 class PDFProcessor:
     """Handles PDF text extraction and paragraph-based chunking for RAG system."""
     
@@ -23,39 +26,34 @@ class PDFProcessor:
     
     def extract_text_from_pdf(self) -> str:
         """Extract all text from the PDF file."""
-        with open(self.pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
+        with pymupdf.open(self.pdf_path) as pdf_document:
+            parts = []
             logger.info(f"Processing PDF: {self.pdf_path}")
-            logger.info(f"Total pages: {len(pdf_reader.pages)}")
-            for page_num, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                text += f"\n\n--- Page {page_num + 1} ---\n\n"
-                text += page_text if page_text else ""
+            logger.info(f"Total pages: {pdf_document.page_count}")
+            for page_num, page in enumerate(pdf_document):
+                page_text = page.get_text()
+                parts.append(f"\n\n--- Page {page_num + 1} ---\n\n")
+                parts.append(page_text if page_text else "")
                 if page_num % 10 == 0:
                     logger.info(f"Processed page {page_num + 1}")
             logger.info("PDF text extraction completed")
-            return text
+            return "".join(parts)
     
     def paragraph_chunk_text(self, text: str) -> List[Dict[str, Any]]:
         """Split text into chunks at paragraph markers like 3.1, 3.2, etc."""
-        # Regex: match paragraph markers at the start of a line (optionally after whitespace)
-        pattern = re.compile(r'(\n|^)(\d+\.\d+)', re.MULTILINE)
-        splits = [m.start(2) for m in pattern.finditer(text)]
-        splits.append(len(text))
+        # Each chunk runs from its marker to the next one; the marker itself is
+        # already captured by the split match
+        matches = list(PARAGRAPH_MARKER_PATTERN.finditer(text))
+        ends = [m.start(2) for m in matches[1:]] + [len(text)]
         chunks = []
-        for i in range(len(splits) - 1):
-            start = splits[i]
-            end = splits[i+1]
-            chunk = text[start:end].strip()
+        for i, (match, end) in enumerate(zip(matches, ends)):
+            chunk = text[match.start(2):end].strip()
             if chunk and len(chunk) > 20:
-                marker_match = re.match(r'^(\d+\.\d+)', chunk)
-                marker = marker_match.group(1) if marker_match else f"chunk_{i}"
                 chunks.append({
                     "content": chunk,
                     "metadata": {
                         "chunk_id": i,
-                        "marker": marker,
+                        "marker": match.group(2),
                         "source": "meditations_pdf",
                         "chunk_size": len(chunk)
                     }
@@ -1,8 +1,14 @@
 import os
-from typing import List, Dict, Any, Optional
+import json
+import asyncio
+from typing import List, Dict, Any, Iterator, Optional
 import logging
+import threading
+import time
+import httpx
+import numpy as np
 import requests
-import json
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 from vector_store import VectorStore
@@ -11,6 +17,22 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+SYSTEM_PROMPT = "You are an expert on Marcus Aurelius's 'Meditations'. Provide concise, direct answers (4-5 sentences maximum) based on the provided passages. Always include at least one direct quotation from the text to support your answer. Use quotation marks for direct quotes. Be precise and avoid lengthy explanations."
+# Shared by every request payload; only ever serialized, never mutated
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Paraphrased questions at or above this cosine similarity reuse a cached answer
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_SIZE = 512
+
+# Concurrent OpenRouter requests per batch; free-tier models rate-limit bursts with 429s
+BATCH_MAX_CONCURRENCY = 4
+
+# The sidebar asks for system info on every Streamlit rerun
+SYSTEM_INFO_TTL_SECONDS = 5
+
 # Commented out GeminiChunkingError and Gemini code
 # class GeminiChunkingError(Exception):
 #     def __init__(self, message, stage=None):
@@ -25,57 +47,145 @@ class RAGEngine:
         self.api_key = os.getenv("OPENROUTER_API_KEY")
         if not self.api_key:
             raise ValueError("OPENROUTER_API_KEY environment variable is required")
+        # One keep-alive session so follow-up questions skip the TCP/TLS handshake
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        })
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        # Async client for concurrent questions, created per event loop because its
+        # pooled connections belong to the loop that opened them (see _get_aclient)
+        self._aclient: Optional[httpx.AsyncClient] = None
+        self._aclient_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._aclient_lock = threading.Lock()
+        # Semantic answer cache: normalized query embeddings (rows, oldest first) and their results
+        self._qcache_embs: Optional[np.ndarray] = None
+        self._qcache_entries: List[Dict[str, Any]] = []
+        self._qcache_lock = threading.Lock()
+        # (monotonic timestamp, info) from the last get_system_info call
+        self._system_info_cache = None
         logger.info("RAG engine initialized with OpenRouter kimi-k2 model")
     
     def retrieve_relevant_context(self, query: str, n_results: int = 5) -> List[Dict[str, Any]]:
-        try:
-            results = self.vector_store.search(query, n_results=n_results)
-            logger.info(f"Retrieved {len(results)} relevant passages")
-            return results
-        except Exception as e:
-            logger.error(f"Error retrieving context: {e}")
-            raise Exception(f"Error retrieving context: {e}")
+        results = self.vector_store.search(query, n_results=n_results)
+        logger.info(f"Retrieved {len(results)} relevant passages")
+        return results
+    
+    def _build_request_data(self, query: str, context: List[Dict[str, Any]], model: str) -> Dict[str, Any]:
+        context_text = "\n\n".join([
+            f"Passage {i+1}:\n{doc['content']}"
+            for i, doc in enumerate(context)
+        ])
+        user_prompt = f"Question: {query}\n\nRelevant passages from Meditations:\n{context_text}\n\nProvide a concise answer (4-5 sentences) with at least one direct quotation from the text:"
+        messages = [
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": user_prompt}
+        ]
+        return {
+            "model": model,
+            "messages": messages
+        }
+    
+    def _parse_response(self, response, model: str) -> str:
+        # requests and httpx responses share status_code/text/json()
+        if response.status_code == 200:
+            result = response.json()
+            answer = result["choices"][0]["message"]["content"]
+            logger.info("Generated response with %s", model)
+            return answer
+        else:
+            raise Exception(f"OpenRouter API error: {response.status_code} {response.text}")
+    
+    def generate_response_stream(self, query: str, context: List[Dict[str, Any]], model: str = "moonshotai/kimi-k2:free") -> Iterator[str]:
+        """Yield answer tokens as OpenRouter streams them (server-sent events)."""
+        data = self._build_request_data(query, context, model)
+        data["stream"] = True
+        with self.session.post(
+            url=OPENROUTER_URL,
+            json=data,
+            stream=True,
+            timeout=(10, 120)
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"OpenRouter API error: {response.status_code} {response.text}")
+            for line in response.iter_lines():
+                # Skips blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+                if not line.startswith(b"data: "):
+                    continue
+                payload = line[len(b"data: "):]
+                if payload == b"[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if "error" in chunk:
+                    raise Exception(f"OpenRouter API error: {chunk['error'].get('message', chunk['error'])}")
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+        logger.info("Generated response with %s", model)
     
     def generate_response(self, query: str, context: List[Dict[str, Any]], model: str = "moonshotai/kimi-k2:free") -> str:
-        try:
-            context_text = "\n\n".join([
-                f"Passage {i+1}:\n{doc['content']}"
-                for i, doc in enumerate(context)
-            ])
-            system_prompt = "You are an expert on Marcus Aurelius's 'Meditations'. Provide concise, direct answers (4-5 sentences maximum) based on the provided passages. Always include at least one direct quotation from the text to support your answer. Use quotation marks for direct quotes. Be precise and avoid lengthy explanations."
-            user_prompt = f"Question: {query}\n\nRelevant passages from Meditations:\n{context_text}\n\nProvide a concise answer (4-5 sentences) with at least one direct quotation from the text:"
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            data = {
-                "model": model,
-                "messages": messages
-            }
-            response = requests.post(
-                url="https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                data=json.dumps(data)
-            )
-            if response.status_code == 200:
-                result = response.json()
-                answer = result["choices"][0]["message"]["content"]
-                logger.info("Generated response with %s", model)
-                return answer
+        return "".join(self.generate_response_stream(query, context, model=model))
+    
+    def _get_aclient(self) -> httpx.AsyncClient:
+        """Return the async client for the running event loop, replacing one left over from an earlier loop."""
+        loop = asyncio.get_running_loop()
+        with self._aclient_lock:
+            if self._aclient is None or self._aclient_loop is not loop:
+                # A client from a finished loop (e.g. a previous asyncio.run) can't be reused or
+                # closed from here; its connections went away with that loop
+                self._aclient = httpx.AsyncClient(
+                    http2=True,
+                    headers=dict(self.session.headers),
+                    timeout=httpx.Timeout(120, connect=10),
+                    limits=httpx.Limits(max_keepalive_connections=16)
+                )
+                self._aclient_loop = loop
+            return self._aclient
+    
+    async def _agenerate_response(self, query: str, context: List[Dict[str, Any]], model: str = "moonshotai/kimi-k2:free") -> str:
+        data = self._build_request_data(query, context, model)
+        response = await self._get_aclient().post(OPENROUTER_URL, json=data)
+        return self._parse_response(response, model)
+    
+    def _normalized_query_embedding(self, query: str) -> np.ndarray:
+        query_embedding = np.asarray(self.vector_store.encode_query(query), dtype=np.float32)
+        return query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+    
+    def _get_cached_answer(self, query: str, query_embedding: np.ndarray, n_context: int, model: str) -> Optional[Dict[str, Any]]:
+        """Return the answer to a near-identical earlier question asked with the same settings."""
+        with self._qcache_lock:
+            if not self._qcache_entries:
+                return None
+            similarities = self._qcache_embs @ query_embedding
+            for index in np.argsort(-similarities):
+                if similarities[index] < SEMANTIC_CACHE_THRESHOLD:
+                    return None
+                entry = self._qcache_entries[index]
+                if entry["model"] == model and entry["n_context"] == n_context:
+                    # Move to the back so it is evicted last
+                    self._qcache_embs = np.vstack([np.delete(self._qcache_embs, index, axis=0), self._qcache_embs[index]])
+                    self._qcache_entries.append(self._qcache_entries.pop(index))
+                    logger.info(f"Semantic cache hit (similarity {similarities[index]:.3f}) for: {query}")
+                    return {**entry["result"], "question": query}
+            return None
+    
+    def _cache_answer(self, query_embedding: np.ndarray, n_context: int, model: str, result: Dict[str, Any]) -> None:
+        with self._qcache_lock:
+            if self._qcache_embs is None:
+                self._qcache_embs = query_embedding[np.newaxis, :]
             else:
-                logger.error(f"OpenRouter API error: {response.status_code} {response.text}")
-                raise Exception(f"OpenRouter API error: {response.status_code} {response.text}")
-        except Exception as e:
-            logger.error(f"Unexpected error in generate_response: {e}")
-            raise Exception(f"Error generating response: {e}")
+                self._qcache_embs = np.vstack([self._qcache_embs[-(SEMANTIC_CACHE_SIZE - 1):], query_embedding])
+            self._qcache_entries.append({"model": model, "n_context": n_context, "result": result})
+            del self._qcache_entries[:-SEMANTIC_CACHE_SIZE]
     
     def answer_question(self, query: str, n_context: int = 5, model: str = "moonshotai/kimi-k2:free") -> Dict[str, Any]:
         try:
             logger.info(f"Processing question: {query}")
+            query_embedding = self._normalized_query_embedding(query)
+            cached = self._get_cached_answer(query, query_embedding, n_context, model)
+            if cached is not None:
+                return cached
             context = self.retrieve_relevant_context(query, n_context)
             answer = self.generate_response(query, context, model=model)
             result = {
@@ -84,20 +194,158 @@ class RAGEngine:
                 "context": context,
                 "num_context_passages": len(context)
             }
+            self._cache_answer(query_embedding, n_context, model, result)
+            logger.info("RAG pipeline completed successfully")
+            return result
+        except Exception as e:
+            logger.error(f"Error in RAG pipeline: {e}")
+            raise
+    
+    def answer_question_stream(self, query: str, n_context: int = 5, model: str = "moonshotai/kimi-k2:free") -> Dict[str, Any]:
+        """Like answer_question, but the answer arrives as an "answer_stream" token iterator."""
+        try:
+            logger.info(f"Processing question: {query}")
+            query_embedding = self._normalized_query_embedding(query)
+            cached = self._get_cached_answer(query, query_embedding, n_context, model)
+            if cached is not None:
+                return {**cached, "answer_stream": iter([cached["answer"]])}
+            context = self.retrieve_relevant_context(query, n_context)
+            result = {
+                "question": query,
+                "context": context,
+                "num_context_passages": len(context)
+            }
+        except Exception as e:
+            logger.error(f"Error in RAG pipeline: {e}")
+            raise
+        
+        def answer_stream() -> Iterator[str]:
+            tokens = []
+            try:
+                for token in self.generate_response_stream(query, context, model=model):
+                    tokens.append(token)
+                    yield token
+            except Exception as e:
+                logger.error(f"Error in RAG pipeline: {e}")
+                raise
+            # Only complete answers go into the semantic cache
+            self._cache_answer(query_embedding, n_context, model, {**result, "answer": "".join(tokens)})
+            logger.info("RAG pipeline completed successfully")
+        
+        return {**result, "answer_stream": answer_stream()}
+    
+    async def aanswer_question(self, query: str, n_context: int = 5, model: str = "moonshotai/kimi-k2:free") -> Dict[str, Any]:
+        """Async variant of answer_question, so callers can asyncio.gather many questions.
+        
+        The HTTP client is bound to the event loop it is first used on; a later loop (such as a
+        second asyncio.run) gets a fresh client. Await aclose() before the loop ends to release
+        its connections.
+        """
+        try:
+            logger.info(f"Processing question: {query}")
+            # ChromaDB and the embedding model are synchronous
+            query_embedding = await asyncio.to_thread(self._normalized_query_embedding, query)
+            cached = self._get_cached_answer(query, query_embedding, n_context, model)
+            if cached is not None:
+                return cached
+            context = await asyncio.to_thread(self.retrieve_relevant_context, query, n_context)
+            answer = await self._agenerate_response(query, context, model=model)
+            result = {
+                "question": query,
+                "answer": answer,
+                "context": context,
+                "num_context_passages": len(context)
+            }
+            self._cache_answer(query_embedding, n_context, model, result)
             logger.info("RAG pipeline completed successfully")
             return result
         except Exception as e:
             logger.error(f"Error in RAG pipeline: {e}")
             raise
     
+    async def aanswer_batch(self, queries: List[str], n_context: int = 5, model: str = "moonshotai/kimi-k2:free", max_concurrency: int = BATCH_MAX_CONCURRENCY) -> List[Dict[str, Any]]:
+        """Answer many questions at once: one batched encode, one vector search, concurrent LLM calls.
+        
+        At most max_concurrency questions are sent to OpenRouter at a time. A question whose
+        generation fails gets "answer": None and an "error" message instead of failing the batch.
+        """
+        try:
+            logger.info(f"Processing batch of {len(queries)} questions")
+            if not queries:
+                return []
+            query_embeddings = await asyncio.to_thread(self.vector_store.encode_queries, queries)
+            normalized = query_embeddings / np.maximum(np.linalg.norm(query_embeddings, axis=1, keepdims=True), 1e-12)
+            results = [
+                self._get_cached_answer(query, query_embedding, n_context, model)
+                for query, query_embedding in zip(queries, normalized)
+            ]
+            pending = [i for i, result in enumerate(results) if result is None]
+            if pending:
+                contexts = await asyncio.to_thread(
+                    self.vector_store.search_batch,
+                    [queries[i] for i in pending],
+                    n_context,
+                    query_embeddings[pending]
+                )
+                semaphore = asyncio.Semaphore(max_concurrency)
+                
+                async def generate(query: str, context: List[Dict[str, Any]]) -> str:
+                    async with semaphore:
+                        return await self._agenerate_response(query, context, model=model)
+                
+                answers = await asyncio.gather(
+                    *[generate(queries[i], context) for i, context in zip(pending, contexts)],
+                    return_exceptions=True
+                )
+                for i, context, answer in zip(pending, contexts, answers):
+                    results[i] = {
+                        "question": queries[i],
+                        "answer": answer,
+                        "context": context,
+                        "num_context_passages": len(context)
+                    }
+                    if isinstance(answer, Exception):
+                        logger.error(f"Error answering {queries[i]!r} in batch: {answer}")
+                        results[i].update({"answer": None, "error": str(answer)})
+                    else:
+                        self._cache_answer(normalized[i], n_context, model, results[i])
+            logger.info("RAG batch pipeline completed successfully")
+            return results
+        except Exception as e:
+            logger.error(f"Error in RAG batch pipeline: {e}")
+            raise
+    
+    def answer_batch(self, queries: List[str], n_context: int = 5, model: str = "moonshotai/kimi-k2:free", max_concurrency: int = BATCH_MAX_CONCURRENCY) -> List[Dict[str, Any]]:
+        """Synchronous wrapper around aanswer_batch for scripts and evaluation runs."""
+        async def run() -> List[Dict[str, Any]]:
+            try:
+                return await self.aanswer_batch(queries, n_context, model=model, max_concurrency=max_concurrency)
+            finally:
+                await self.aclose()
+        
+        return asyncio.run(run())
+    
+    async def aclose(self):
+        """Close the running event loop's async HTTP client and its pooled connections."""
+        with self._aclient_lock:
+            if self._aclient is None or self._aclient_loop is not asyncio.get_running_loop():
+                return
+            aclient, self._aclient, self._aclient_loop = self._aclient, None, None
+        await aclient.aclose()
+    
     def get_system_info(self) -> Dict[str, Any]:
         try:
+            cached = self._system_info_cache
+            if cached is not None and time.monotonic() - cached[0] < SYSTEM_INFO_TTL_SECONDS:
+                return cached[1]
             vector_store_info = self.vector_store.get_collection_info()
-            return {
+            info = {
                 "vector_store": vector_store_info,
                 "model": "moonshotai/kimi-k2:free",
                 "status": "ready"
             }
+            self._system_info_cache = (time.monotonic(), info)
+            return info
         except Exception as e:
             logger.error(f"Error getting system info: {e}")
             raise
@@ -62,7 +62,7 @@ def test_imports():
         import google.generativeai
         import chromadb
         import sentence_transformers
-        import PyPDF2
+        import pymupdf
         logger.info("All required modules imported successfully")
         return True
     except ImportError as e:
@@ -1,10 +1,23 @@
 import re
 import os
+import hashlib
 from typing import List, Dict, Any, Optional
 import logging
+from bisect import bisect_right
+from itertools import accumulate
 
 logger = logging.getLogger(__name__)
 
+_WHITESPACE_PATTERN = re.compile(r'\s+')
+_SPECIAL_CHARS_PATTERN = re.compile(r'[^\w\s\.\,\;\:\!\?\-\(\)]')
+_UNSAFE_QUERY_CHARS_PATTERN = re.compile(r'[<>"\']')
+# Matching the punctuation itself (rather than a lookbehind) lets the regex engine
+# scan ahead for the next [.!?] instead of testing every position
+_SENTENCE_END_PATTERN = re.compile(r'([.!?])\s+')
+# Same page marker as in extract_text_from_pdf
+_PAGE_MARKER_PATTERN = re.compile(r'\n\n--- Page (\d+) ---\n\n')
+_FOOTNOTE_LINE_PATTERN = re.compile(r'(\d+\.|\[\d+\])')
+
 def clean_text(text: str) -> str:
     """Clean and normalize text content.
     
@@ -14,17 +27,9 @@ def clean_text(text: str) -> str:
     Returns:
         Cleaned text.
     """
-    # Remove extra whitespace
-    text = re.sub(r'\s+', ' ', text)
-    
-    # Remove special characters but keep punctuation
-    text = re.sub(r'[^\w\s\.\,\;\:\!\?\-\(\)]', '', text)
-    
-    # Normalize quotes
-    text = text.replace('"', '"').replace('"', '"')
-    text = text.replace(''', "'").replace(''', "'")
-    
-    return text.strip()
+    # Collapse whitespace, then drop special characters but keep punctuation
+    # (quotes are stripped too, so they need no separate normalization)
+    return _SPECIAL_CHARS_PATTERN.sub('', _WHITESPACE_PATTERN.sub(' ', text)).strip()
 
 def validate_pdf_path(pdf_path: str) -> bool:
     """Validate that a PDF file exists and is accessible.
@@ -59,22 +64,22 @@ def chunk_text_by_sentences(text: str, max_chunk_size: int = 1000) -> List[str]:
     Returns:
         List of text chunks.
     """
-    # Split by sentence endings
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    # Split by sentence endings, keeping the punctuation with its sentence
+    parts = _SENTENCE_END_PATTERN.split(text)
+    sentences = [body + end for body, end in zip(parts[0::2], parts[1::2])]
+    sentences.append(parts[-1])
     
-    chunks = []
-    current_chunk = ""
-    
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_chunk_size:
-            current_chunk += sentence + " "
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + " "
+    # bounds[i] is the length of sentences[:i] joined with trailing spaces, so a
+    # chunk from start can grow to the last bound within max_chunk_size + 1 of it
+    bounds = list(accumulate((len(sentence) + 1 for sentence in sentences), initial=0))
     
-    if current_chunk:
-        chunks.append(current_chunk.strip())
+    chunks = []
+    start = 0
+    while start < len(sentences):
+        # A sentence longer than max_chunk_size still gets a chunk of its own
+        end = max(start + 1, bisect_right(bounds, bounds[start] + max_chunk_size + 1, start) - 1)
+        chunks.append(' '.join(sentences[start:end]).strip())
+        start = end
     
     return chunks
 
@@ -155,13 +160,8 @@ def sanitize_query(query: str) -> str:
     Returns:
         Sanitized query.
     """
-    # Remove potentially harmful characters
-    query = re.sub(r'[<>"\']', '', query)
-    
-    # Normalize whitespace
-    query = re.sub(r'\s+', ' ', query)
-    
-    return query.strip()
+    # Remove potentially harmful characters, then normalize whitespace
+    return _WHITESPACE_PATTERN.sub(' ', _UNSAFE_QUERY_CHARS_PATTERN.sub('', query)).strip()
 
 def calculate_similarity_score(distance: float) -> float:
     """Convert distance to similarity score.
@@ -175,6 +175,23 @@ def calculate_similarity_score(distance: float) -> float:
     # Convert distance to similarity (lower distance = higher similarity)
     return max(0, 1 - distance)
 
+def compute_file_hash(file_path: str) -> str:
+    """Compute the SHA-256 hash of a file's contents.
+    
+    Args:
+        file_path: Path to the file.
+        
+    Returns:
+        Hexadecimal SHA-256 digest.
+    """
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # Python 3.11+
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+        return digest.hexdigest()
+
 def get_file_size_mb(file_path: str) -> float:
     """Get file size in megabytes.
     
@@ -194,29 +211,21 @@ def remove_end_of_page_footnotes(text: str) -> str:
     """Remove end-of-page footnotes from extracted PDF text.
     Footnotes are lines at the end of a page that start with a number and a period or bracket (e.g., '1. text' or '[1] text').
     """
-    # Use the same page marker as in extract_text_from_pdf
-    page_marker_pattern = r'\n\n--- Page (\d+) ---\n\n'
-    pages = re.split(page_marker_pattern, text)
-    cleaned_pages = []
+    pages = _PAGE_MARKER_PATTERN.split(text)
     # pages will be like: [before first page, '1', page1, '2', page2, ...]
     # We want to keep the page numbers and clean the page text
-    i = 0
-    while i < len(pages):
-        if i == 0:
-            # Text before first page marker
-            cleaned_pages.append(pages[i])
-            i += 1
-        else:
-            # Page number and page text
-            page_num = pages[i]
-            page_text = pages[i+1]
-            lines = page_text.strip().split('\n')
-            # Remove trailing lines that match footnote pattern
-            while lines and re.match(r'^(\d+\.|\[\d+\])', lines[-1].strip()):
-                lines.pop()
-            cleaned_page = '\n'.join(lines)
-            cleaned_pages.append(f'--- Page {page_num} ---\n\n{cleaned_page}')
-            i += 2
+    cleaned_pages = [pages[0]]
+    for page_num, page_text in zip(pages[1::2], pages[2::2]):
+        page_text = page_text.strip()
+        # Walk back over trailing lines that match the footnote pattern without
+        # splitting the whole page into lines
+        end = len(page_text)
+        while end > 0:
+            line_start = page_text.rfind('\n', 0, end) + 1
+            if not _FOOTNOTE_LINE_PATTERN.match(page_text[line_start:end].lstrip()):
+                break
+            end = max(line_start - 1, 0)
+        cleaned_pages.append(f'--- Page {page_num} ---\n\n{page_text[:end]}')
     return '\n\n'.join(cleaned_pages)
 
 if __name__ == "__main__":
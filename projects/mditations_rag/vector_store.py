@@ -3,11 +3,32 @@ from chromadb.config import Settings
 from typing import List, Dict, Any, Optional
 import os
 import logging
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+import numpy as np
 from sentence_transformers import SentenceTransformer
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Cached query embeddings are only valid for the model build and compute dtype that
+# produced them; the dtype suffix ("|fp32" or "|fp16") is added per instance
+EMBEDDING_CACHE_NAMESPACE = "all-mpnet-base-v2|torch"
+
+# mpnet is trained for cosine similarity; denser graph built once, wider beam than the default 10 at query time
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 32
+}
+
+# Up to this many chunks, search is one exact matrix-vector product over an in-memory
+# copy of the embeddings, which beats a round trip through Chroma's query API
+IN_MEMORY_SEARCH_LIMIT = 50_000
+
 class VectorStore:
     """Manages ChromaDB vector database operations for RAG system."""
     
@@ -30,10 +51,33 @@ class VectorStore:
         # Initialize better sentence transformer for embeddings
         # all-mpnet-base-v2 is better than all-MiniLM-L6-v2 for semantic search
         self.embedding_model = SentenceTransformer('all-mpnet-base-v2')
+        # FP16 halves weight traffic on a GPU; on CPU torch already runs one
+        # intra-op thread per physical core and half precision would be slower
+        compute_dtype = "fp32"
+        if self.embedding_model.device.type == "cuda":
+            self.embedding_model.half()
+            compute_dtype = "fp16"
+        self._embedding_cache_namespace = f"{EMBEDDING_CACHE_NAMESPACE}|{compute_dtype}"
+        
+        # Query embeddings persist next to the Chroma files so a restart starts warm
+        self._embedding_cache = sqlite3.connect(
+            os.path.join(persist_directory, "embed_cache.sqlite"),
+            check_same_thread=False
+        )
+        self._embedding_cache.execute("CREATE TABLE IF NOT EXISTS ec (key BLOB PRIMARY KEY, vec BLOB)")
+        self._embedding_cache_lock = threading.Lock()
+        
+        # Repeated questions skip the transformer forward pass; tuples keep cached vectors immutable
+        self._encode_query = lru_cache(maxsize=1024)(
+            lambda query: tuple(self._encode_queries_cached([query])[0].tolist())
+        )
         
         # Get or create collection
         self.collection = self._get_or_create_collection()
         
+        # (unit-normalized embeddings, ids, documents, metadatas), built on first search
+        self._memory_index = None
+        
         logger.info(f"Vector store initialized with all-mpnet-base-v2: {collection_name}")
     
     def _get_or_create_collection(self):
@@ -41,10 +85,15 @@ class VectorStore:
         try:
             collection = self.client.get_collection(name=self.collection_name)
             logger.info(f"Using existing collection: {self.collection_name}")
+            # The distance space is fixed at creation, so older L2 collections are rebuilt
+            if (collection.metadata or {}).get("hnsw:space") != HNSW_METADATA["hnsw:space"]:
+                logger.info(f"Recreating collection {self.collection_name} with cosine distance")
+                self.client.delete_collection(name=self.collection_name)
+                raise ValueError("stale collection")
         except:
             collection = self.client.create_collection(
                 name=self.collection_name,
-                metadata={"description": "Meditations by Marcus Aurelius"}
+                metadata={"description": "Meditations by Marcus Aurelius", **HNSW_METADATA}
             )
             logger.info(f"Created new collection: {self.collection_name}")
         
@@ -61,8 +110,13 @@ class VectorStore:
             metadatas = [doc["metadata"] for doc in documents]
             ids = [f"chunk_{i}" for i in range(len(documents))]
             
-            # Generate embeddings with better model
-            embeddings = self.embedding_model.encode(contents).tolist()
+            # Generate embeddings with better model; chromadb 0.4 only accepts lists
+            embeddings = self.embedding_model.encode(
+                contents,
+                batch_size=64,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            ).tolist()
             
             # Add to collection
             self.collection.add(
@@ -72,12 +126,66 @@ class VectorStore:
                 ids=ids
             )
             
+            self._memory_index = None
             logger.info(f"Added {len(documents)} documents to vector store")
             
         except Exception as e:
             logger.error(f"Error adding documents to vector store: {e}")
             raise
     
+    def encode_query(self, query: str) -> List[float]:
+        """Embed a query string, reusing the cached vector for repeated queries.
+        
+        Args:
+            query: Query string.
+            
+        Returns:
+            Query embedding.
+        """
+        return list(self._encode_query(query))
+    
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Embed several query strings in one batched forward pass.
+        
+        Args:
+            queries: Query strings.
+            
+        Returns:
+            Array of query embeddings, one row per query.
+        """
+        return self._encode_queries_cached(queries)
+    
+    def _encode_queries_cached(self, queries: List[str]) -> np.ndarray:
+        """Embed queries, reading and filling the on-disk embedding cache."""
+        keys = [
+            hashlib.sha256(f"{self._embedding_cache_namespace}|{query}".encode("utf-8")).digest()
+            for query in queries
+        ]
+        cached = {}
+        with self._embedding_cache_lock:
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                cached.update(self._embedding_cache.execute(
+                    f"SELECT key, vec FROM ec WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ))
+        
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        if missing:
+            embeddings = self.embedding_model.encode(
+                [queries[i] for i in missing],
+                batch_size=min(32, len(missing)),
+                convert_to_numpy=True,
+                show_progress_bar=False
+            ).astype(np.float32)
+            new_rows = [(keys[i], embedding.tobytes()) for i, embedding in zip(missing, embeddings)]
+            with self._embedding_cache_lock, self._embedding_cache:
+                self._embedding_cache.executemany("INSERT OR REPLACE INTO ec (key, vec) VALUES (?, ?)", new_rows)
+            cached.update(new_rows)
+        
+        return np.stack([np.frombuffer(cached[key], dtype=np.float32) for key in keys])
+    
     def search(self, query: str, n_results: int = 5) -> List[Dict[str, Any]]:
         """Search for similar documents.
         
@@ -88,41 +196,116 @@ class VectorStore:
         Returns:
             List of similar documents with scores.
         """
-        try:
-            # Generate query embedding with better model
-            query_embedding = self.embedding_model.encode([query]).tolist()
-            
-            # Search in collection
-            results = self.collection.query(
-                query_embeddings=query_embedding,
-                n_results=n_results
-            )
-            
-            # Defensive: Check if results are valid and contain expected keys
-            if (
-                not results
-                or "documents" not in results
-                or not results["documents"]
-                or not results["documents"][0]
-            ):
-                logger.warning("No results found in vector store search.")
-                return []
+        # Generate query embedding with better model
+        query_embedding = self.encode_query(query)
+        
+        return self._search_embeddings([query_embedding], n_results)[0]
+    
+    def search_batch(self, queries: List[str], n_results: int = 5, query_embeddings: Optional[np.ndarray] = None) -> List[List[Dict[str, Any]]]:
+        """Search for similar documents for several queries at once.
+        
+        Args:
+            queries: Search query strings.
+            n_results: Number of results to return per query.
+            query_embeddings: Embeddings of the queries, if already computed.
             
+        Returns:
+            One list of similar documents with scores per query.
+        """
+        if not queries:
+            return []
+        if query_embeddings is None:
+            query_embeddings = self.encode_queries(queries)
+        
+        return self._search_embeddings(np.asarray(query_embeddings, dtype=np.float32).tolist(), n_results)
+    
+    def _search_embeddings(self, query_embeddings: List[List[float]], n_results: int) -> List[List[Dict[str, Any]]]:
+        memory_index = self._get_memory_index()
+        if memory_index is not None:
+            return self._search_memory_index(memory_index, query_embeddings, n_results)
+        
+        # Search in collection
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_results
+        )
+        
+        # Defensive: Check if results are valid and contain expected keys
+        if (
+            not results
+            or "documents" not in results
+            or not results["documents"]
+            or not results["documents"][0]
+        ):
+            logger.warning("No results found in vector store search.")
+            return [[] for _ in query_embeddings]
+        
+        all_results = []
+        for q in range(len(query_embeddings)):
             formatted_results = []
-            for i in range(len(results["documents"][0])):
+            for i in range(len(results["documents"][q])):
                 formatted_results.append({
-                    "content": results["documents"][0][i],
-                    "metadata": results["metadatas"][0][i],
-                    "distance": results["distances"][0][i],
-                    "id": results["ids"][0][i]
+                    "content": results["documents"][q][i],
+                    "metadata": results["metadatas"][q][i],
+                    "distance": results["distances"][q][i],
+                    "id": results["ids"][q][i]
                 })
+            all_results.append(formatted_results)
+        
+        logger.info(f"Found {sum(map(len, all_results))} similar documents")
+        return all_results
+    
+    def _get_memory_index(self):
+        """Mirror the collection's embeddings into memory if the corpus is small enough."""
+        if self._memory_index is None:
+            if self.collection.count() > IN_MEMORY_SEARCH_LIMIT:
+                return None
+            stored = self.collection.get(include=["embeddings", "documents", "metadatas"])
+            embeddings = np.asarray(stored["embeddings"], dtype=np.float32).reshape(len(stored["ids"]), -1) if stored["ids"] else np.empty((0, 0), dtype=np.float32)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            # Normalizing once up front makes cosine similarity a single matrix product
+            self._memory_index = (
+                embeddings / np.maximum(norms, 1e-12),
+                stored["ids"],
+                stored["documents"],
+                stored["metadatas"]
+            )
+            logger.info(f"Loaded {len(stored['ids'])} embeddings for in-memory search")
+        return self._memory_index
+    
+    def _search_memory_index(self, memory_index, query_embeddings: List[List[float]], n_results: int) -> List[List[Dict[str, Any]]]:
+        """Exact cosine search over the in-memory mirror, formatted like the Chroma results."""
+        embeddings, ids, documents, metadatas = memory_index
+        if not ids:
+            logger.warning("No results found in vector store search.")
+            return [[] for _ in query_embeddings]
+        
+        query_vectors = np.asarray(query_embeddings, dtype=np.float32)
+        query_vectors = query_vectors / np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+        # One row of similarities per query
+        similarity_rows = query_vectors @ embeddings.T
+        
+        n_results = min(n_results, len(ids))
+        all_results = []
+        for similarities in similarity_rows:
+            if n_results < len(ids):
+                top = np.argpartition(-similarities, n_results - 1)[:n_results]
+            else:
+                top = np.arange(len(ids))
+            top = top[np.argsort(-similarities[top], kind="stable")]
             
-            logger.info(f"Found {len(formatted_results)} similar documents")
-            return formatted_results
-            
-        except Exception as e:
-            logger.error(f"Error searching vector store: {e}")
-            raise
+            all_results.append([
+                {
+                    "content": documents[i],
+                    "metadata": metadatas[i],
+                    # Same cosine distance the collection reports
+                    "distance": float(1.0 - similarities[i]),
+                    "id": ids[i]
+                }
+                for i in top
+            ])
+        logger.info(f"Found {sum(map(len, all_results))} similar documents")
+        return all_results
     
     def get_collection_info(self) -> Dict[str, Any]:
         """Get information about the collection.
@@ -145,7 +328,10 @@ class VectorStore:
     def clear_collection(self) -> None:
         """Clear all documents from the collection."""
         try:
-            self.collection.delete(where={})
+            # Chroma rejects an empty where filter, so drop and recreate instead
+            self.client.delete_collection(name=self.collection_name)
+            self.collection = self._get_or_create_collection()
+            self._memory_index = None
             logger.info("Cleared all documents from collection")
         except Exception as e:
             logger.error(f"Error clearing collection: {e}")